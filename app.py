@@ -1,16 +1,78 @@
+import asyncio
+import atexit
+import functools
+import hashlib
 import logging
+import logging.handlers
 import os
+import queue
+import re
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from operator import attrgetter
 
-from crewai import Agent, Task, Crew, Process
+import httpx
+import orjson
+import yaml
+from cachetools import TTLCache
 from dotenv import load_dotenv
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
+from flask.json.provider import JSONProvider
+from langchain_core.messages import HumanMessage, SystemMessage
 from langchain_openai import ChatOpenAI
+from pydantic import BaseModel, ConfigDict, ValidationError
+
+try:
+    # uvloop заметно быстрее стандартного event loop'а, на нем работает loop батчера
+    import uvloop
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
+
+try:
+    # google-re2 (закреплен в requirements.txt): линейный по времени DFA-поиск, не зависящий
+    # от числа шаблонов. Без него, например в окружении без колес, работает стандартный re
+    import re2 as trigger_regex
+except ImportError:
+    trigger_regex = re
 
 # --- Конфигурация ---
 load_dotenv()
 
-# Настройка логирования
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Настройка логирования. При импорте — обычный синхронный вывод: с preload_app модуль
+# импортируется в мастере gunicorn, и поток, живой в момент fork, может оставить воркеру
+# захваченную блокировку stderr. Очередь с фоновым потоком, чтобы запись логов
+# не блокировала обработку запроса, каждый воркер запускает в init_worker()
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+_log_listener = None
+
+
+def configure_logging():
+    """Направляет корневой логгер в очередь и запускает поток, который разбирает ее."""
+    global _log_listener
+    stop_logging()
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    root_logger = logging.getLogger()
+    root_logger.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root_logger.setLevel(logging.INFO)
+
+    _log_listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    _log_listener.start()
+
+
+@atexit.register
+def stop_logging():
+    """Дописывает оставшиеся в очереди записи при остановке процесса."""
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+
 
 # Получаем ключ и модель из .env
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
@@ -21,169 +83,691 @@ XAI_MODEL_NAME = os.getenv("XAI_MODEL_NAME", "grok-beta")
 
 TELEGRAM_BOT_ID = os.getenv("TELEGRAM_BOT_ID")
 
-if not OPENAI_API_KEY:
-    logging.error("FATAL: OPENAI_API_KEY environment variable not set.")
+# Провайдер LLM (см. PROVIDERS) и персона бота (файл personas/<PERSONA>.yaml)
+LLM_PROVIDER = os.getenv("LLM_PROVIDER", "xai")
+PERSONA = os.getenv("PERSONA", "bro")
+PERSONAS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "personas")
+
+# Таймаут (в секундах) и число повторов для запросов к LLM
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+# Сколько поток запроса ждет ответ LLM с учетом всех повторов
+LLM_DEADLINE = LLM_TIMEOUT * (LLM_MAX_RETRIES + 1)
+
+# CrewAI: для одного агента с одной задачей это лишняя обертка над вызовом LLM,
+# поэтому по умолчанию модель вызывается напрямую. USE_CREWAI=1 возвращает Crew
+USE_CREWAI = os.getenv("USE_CREWAI", "0") == "1"
+# Подробный лог CrewAI печатает весь промпт на каждый запрос, в продакшене выключен
+CREW_VERBOSE = os.getenv("CREW_VERBOSE", "0") == "1"
+
+# Окно истории для LLM: сколько последних сообщений отправлять и (опционально) сколько
+# токенов они могут занять. 0 — без ограничения
+MAX_HISTORY = int(os.getenv("MAX_HISTORY", "20"))
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "0"))
+
+# Кэш ответов на одинаковые промпты (повторы вебхуков, одинаковые пинги). 0 — выключен
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "60"))
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1024"))
+
+# Предфильтр: без обращения к боту (имя, вопрос, упоминание, ответ на его сообщение)
+# LLM не вызываем. Отключение возвращает боту возможность вклиниваться в беседу сам
+PREFILTER_ENABLED = os.getenv("PREFILTER_ENABLED", "1") == "1"
+
+# Микробатчинг: сколько запросов собирать в пачку и сколько ждать (мс) попутчиков.
+# У xAI/OpenAI нет пакетного API, пачка все равно уходит параллельными вызовами,
+# поэтому по умолчанию не ждем: ожидание только добавило бы задержку каждому сообщению
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "8"))
+BATCH_MAX_WAIT_MS = int(os.getenv("BATCH_MAX_WAIT_MS", "0"))
+
+# Параметры ChatOpenAI для каждого провайдера (xAI совместим с OpenAI API).
+# Имя модели — без префикса LiteLLM ("xai/..."): ChatOpenAI отправляет его провайдеру как есть
+PROVIDERS = {
+    "xai": {
+        "api_key": XAI_API_KEY,
+        "model": XAI_MODEL_NAME.removeprefix("xai/"),
+        "base_url": "https://api.x.ai/v1",
+        "temperature": 1.5,
+    },
+    "openai": {
+        "api_key": OPENAI_API_KEY,
+        "model": OPENAI_MODEL_NAME.removeprefix("openai/"),
+    },
+}
+
+if LLM_PROVIDER not in PROVIDERS:
+    logging.error(f"FATAL: Unknown LLM_PROVIDER '{LLM_PROVIDER}', expected one of: {', '.join(PROVIDERS)}.")
+    exit(1)
+
+if not PROVIDERS[LLM_PROVIDER]["api_key"]:
+    logging.error(f"FATAL: API key for LLM provider '{LLM_PROVIDER}' is not set.")
     exit(1)  # Завершаем работу, если ключ не найден
 
 # --- Инициализация Flask ---
+class OrjsonProvider(JSONProvider):
+    """JSON-провайдер Flask на orjson: jsonify и app.json работают быстрее stdlib json."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # --- Инициализация LLM ---
-# Вы можете добавить параметры, если нужно, например, temperature
-
-# openAI
-# llm = ChatOpenAI(
-#     openai_api_key=OPENAI_API_KEY,
-#     model_name=OPENAI_MODEL_NAME
-# )
-
-# xAI
-llm = ChatOpenAI(
-    api_key=XAI_API_KEY,
-    model=XAI_MODEL_NAME,
-    base_url="https://api.x.ai/v1",
-    temperature=1.5,
-)
+# Параметры модели (например, temperature) задаются в PROVIDERS
+
+def create_http_clients():
+    """Создает общие HTTP-клиенты для LLM: sync и async.
+
+    Клиенты переиспользуют TCP/TLS-соединения с провайдером и мультиплексируют
+    запросы по HTTP/2. Async-клиент привязан к event loop'у, поэтому используется
+    только в loop'е батчера.
+    """
+    timeout = httpx.Timeout(LLM_TIMEOUT, connect=5)
+    limits = httpx.Limits(max_connections=200, max_keepalive_connections=100)
+    return (
+        httpx.Client(http2=True, timeout=timeout, limits=limits),
+        httpx.AsyncClient(http2=True, timeout=timeout, limits=limits),
+    )
 
-# --- Определение Агента CrewAI ---
-chat_participant_agent = Agent(
-    role='Участник чата (AI)',
-    goal=(
-        "Отвечать кратко, с характером, на прямые обращения или вопросы. "
-        "Иногда вкидывай смешной коммент, если тема просит. "
-        "Используй мат умеренно, для акцента, если это в духе беседы."
-    ),
-    backstory=(
-        "Ты — AI, но в чате ты как свой в доску: прямой, без розовых очков. "
-        "Говоришь, как мужчина, который не парится из-за мелочей, но всегда по делу. "
-        "Можешь материться. "
-        "Твой вайб — старый друг, с которым уже все темы давно обговорены по 100 раз, который не пытается всем угодить."
-    ),
-    llm=llm,
-    verbose=True,  # Включаем логирование работы агента
-    allow_delegation=False,  # Для MVP агент работает сам
-    # max_iter=5 # Ограничение итераций на всякий случай
-)
 
-# --- Определение Задачи CrewAI ---
+def create_llm(http_client, http_async_client):
+    """Создает клиента LLM выбранного провайдера поверх общих HTTP-клиентов."""
+    return ChatOpenAI(
+        **PROVIDERS[LLM_PROVIDER],
+        timeout=LLM_TIMEOUT,
+        max_retries=LLM_MAX_RETRIES,
+        http_client=http_client,
+        http_async_client=http_async_client,
+    )
+
+
+SHARED_HTTP_CLIENT, SHARED_ASYNC_HTTP_CLIENT = create_http_clients()
+llm = create_llm(SHARED_HTTP_CLIENT, SHARED_ASYNC_HTTP_CLIENT)
+
+# --- Промпты ---
 # Магическая строка, которую агент вернет, если решит не отвечать
 NO_RESPONSE_MARKER = "NO_RESPONSE"
 
-chat_analysis_task = Task(
-    description=(
-        "Тебе предоставлена история последних сообщений в чате и самое новое сообщение.\n"
-        "Формат истории: '[Имя отправителя]: [Текст сообщения]'\n"
-        f"Твой id в истории чата: {TELEGRAM_BOT_ID}.\n"
-        "К тебе могут обращаться в чате по имени Бро или Bro с большой буквы.\n"
-        "Твоя задача: Проанализируй новое сообщение в контексте истории.\n"
-        "Реши, нужно ли тебе ответить на это сообщение или на текущую беседу в целом.\n"
-        "Критерии для ответа:\n"
-        "- ОБЯЗАТЕЛЬНО отвечай, если к тебе обращаются напрямую (например, 'Бро', 'Bro') или задают вопрос, явно адресованный тебе.\n"
-        "- Вклинивайся без обращения ТОЛЬКО если можешь сказать что-то короткое, релевантное и по теме, но делай это редко.\n"
-        "- НЕ отвечай, если последнее сообщение было от тебя.\n"
-        "- НЕ задавай вопросы в своих ответах.\n"
-        "- Пиши кратко, уверенно. Если кто-то тебе дерзит, подкалывай, но по-доброму, при этом используй смайлы, но чаще просто скобочки типа ')', чем эмодзи. Количество скобочек ставь в зависимости от того, насколько твое сообщение смешное. Если просто дружелюбный тон, то одна скобочка, но используй это редко. Если пишешь нейтральное сообщение, то смайлов и скобочек не нужно.\n"
-        "- НЕ используй эмодзи, только если отвечаешь что-то очень смешное.\n"
-        # "- Используй слэнг и мат, например, 'норм' или 'прикинь'.\n"
-        "- Если кто-то неуважительно себя ведет в чате, то ОБЯЗАТЕЛЬНО ставь его на место едким комментарием и подъебывай, при этом используй много матерных слов и обидные высказывания типа 'мамку ебал' и при этом не используй смайлы и скобочки.\n"
-        "- Если тебя попросили о чем-то, то делай все возможное, чтобы помочь. "
-        "- Формулируй ответ на РУССКОМ языке.\n"
-        f"Если ты решил ответить, напиши текст своего ответа.\n"
-        f"Если ты решил НЕ отвечать, ВЕРНИ ТОЛЬКО СТРОКУ: {NO_RESPONSE_MARKER}\n\n"
-        "ИСТОРИЯ ЧАТА (последние сообщения):\n"
-        "-------------------------------------\n"
-        "{chat_history}\n"
-        "-------------------------------------\n\n"
-        "НОВОЕ СООБЩЕНИЕ:\n"
-        "-------------------------------------\n"
-        "{new_message}\n"
-        "-------------------------------------\n\n"
-        f"Твой ответ (или {NO_RESPONSE_MARKER}):"
-    ),
-    expected_output=(
-            "Текст твоего ответа на русском языке, если ты решил ответить. "
-            "Или ТОЧНО строка '" + NO_RESPONSE_MARKER + "', если ты решил не отвечать."
-    ),
-    agent=chat_participant_agent
-)
 
-# --- Создание Crew ---
-crew = Crew(
-    agents=[chat_participant_agent],
-    tasks=[chat_analysis_task],
-    process=Process.sequential,
-    verbose=True
+def load_persona(name):
+    """Загружает описание персоны (имена, роль, цель, предыстория, правила) из personas/<name>.yaml."""
+    with open(os.path.join(PERSONAS_DIR, f"{name}.yaml"), encoding="utf-8") as f:
+        return yaml.safe_load(f)
+
+
+try:
+    persona = load_persona(PERSONA)
+except FileNotFoundError:
+    logging.error(f"FATAL: Persona file for PERSONA '{PERSONA}' not found in {PERSONAS_DIR}.")
+    exit(1)
+
+# Статичная часть промпта: не меняется между запросами, поэтому уходит в системное
+# сообщение и кэшируется провайдером (xAI/OpenAI кэшируют совпадающий префикс)
+SYSTEM_PROMPT = persona['rules'].format(bot_id=TELEGRAM_BOT_ID, no_response_marker=NO_RESPONSE_MARKER)
+
+# Динамическая часть: история всегда идет в конце промпта, чтобы не сбивать кэшируемый префикс
+USER_PROMPT_TEMPLATE = (
+    "ИСТОРИЯ ЧАТА (последние сообщения):\n"
+    "-------------------------------------\n"
+    "{chat_history}\n"
+    "-------------------------------------\n\n"
+    "НОВОЕ СООБЩЕНИЕ:\n"
+    "-------------------------------------\n"
+    "{new_message}\n"
+    "-------------------------------------\n\n"
+    f"Твой ответ (или {NO_RESPONSE_MARKER}):"
 )
 
+AGENT_ROLE = persona['role']
+AGENT_GOAL = persona['goal']
+AGENT_BACKSTORY = persona['backstory']
+# Имена, по которым к боту обращаются в чате
+AGENT_NAMES = persona.get('names', [])
+
+# Системный промпт для прямых вызовов LLM в обход CrewAI: персона + статичные правила
+PERSONA_SYSTEM_PROMPT = f"Ты — {AGENT_ROLE}. {AGENT_BACKSTORY}\nТвоя цель: {AGENT_GOAL}\n\n{SYSTEM_PROMPT}"
+
+# --- CrewAI (включается через USE_CREWAI) ---
+def build_crew():
+    """Собирает Crew из одного агента и одной задачи."""
+    from crewai import Agent, Task, Crew, Process, LLM
+
+    class StaticPromptAgent(Agent):
+        """Агент со статичными role/goal/backstory.
+
+        CrewAI на каждом kickoff подставляет inputs в описание агента, прогоняя
+        многокилобайтный системный промпт через поиск плейсхолдеров. У нас там
+        плейсхолдеров нет, поэтому интерполяцию пропускаем.
+        """
+
+        def interpolate_inputs(self, inputs):
+            pass
+
+    # CrewAI вызывает модель через LiteLLM, которому нужен префикс провайдера в имени модели.
+    # Передаем LLM явно: при конвертации из ChatOpenAI CrewAI теряет таймаут и повторы
+    provider_config = PROVIDERS[LLM_PROVIDER]
+    crew_llm = LLM(
+        model=f"{LLM_PROVIDER}/{provider_config['model']}",
+        api_key=provider_config['api_key'],
+        base_url=provider_config.get('base_url'),
+        temperature=provider_config.get('temperature'),
+        timeout=LLM_TIMEOUT,
+        num_retries=LLM_MAX_RETRIES,
+    )
+
+    chat_participant_agent = StaticPromptAgent(
+        role=AGENT_ROLE,
+        goal=AGENT_GOAL,
+        # CrewAI кладет backstory в системное сообщение, туда же отправляем статичные правила
+        backstory=f"{AGENT_BACKSTORY}\n\n{SYSTEM_PROMPT}",
+        llm=crew_llm,
+        verbose=CREW_VERBOSE,  # Логирование работы агента
+        allow_delegation=False,  # Для MVP агент работает сам
+        # max_iter=5 # Ограничение итераций на всякий случай
+    )
+
+    chat_analysis_task = Task(
+        description=USER_PROMPT_TEMPLATE,
+        expected_output=(
+                "Текст твоего ответа на русском языке, если ты решил ответить. "
+                "Или ТОЧНО строка '" + NO_RESPONSE_MARKER + "', если ты решил не отвечать."
+        ),
+        agent=chat_participant_agent
+    )
+
+    return Crew(
+        agents=[chat_participant_agent],
+        tasks=[chat_analysis_task],
+        process=Process.sequential,
+        verbose=CREW_VERBOSE
+    )
+
+
+crew = build_crew() if USE_CREWAI else None
+
+
+# --- Микробатчинг вызовов LLM ---
+class MicroBatcher:
+    """Собирает запросы, пришедшие почти одновременно, и запускает их одной пачкой.
+
+    Эндпоинты Flask синхронные, поэтому очередь и обработчик пачек живут в собственном
+    фоновом loop'е, а потоки запросов передают в него данные потокобезопасно и ждут
+    результат.
+
+    run_batch получает список входных данных пачки и возвращает по awaitable на каждый
+    элемент: каждый запрос получает свой результат, как только готов его вызов, и не ждет
+    самый медленный вызов в пачке.
+    """
+
+    def __init__(self, run_batch, max_size, max_wait_ms):
+        self._run_batch = run_batch
+        self._max_size = max_size
+        self._max_wait = max_wait_ms / 1000
+        self._loop = None
+        self._queue = None
+        self._lock = threading.Lock()
+
+    def submit(self, inputs, timeout=None):
+        """Ставит входные данные в очередь и блокирует поток до результата их обработки."""
+        loop = self._ensure_started()
+        future = asyncio.run_coroutine_threadsafe(self._enqueue(inputs), loop)
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise
+
+    def _ensure_started(self):
+        # Поток запускается лениво, при первом запросе
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._run_loop, name="llm-batcher", daemon=True).start()
+            return self._loop
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._queue = asyncio.Queue()
+        self._loop.create_task(self._collect_batches())
+        self._loop.run_forever()
+
+    def run_in_loop(self, coro, timeout=None):
+        """Синхронно выполняет корутину в loop'е батчера (или в новом, если он не запущен)."""
+        with self._lock:
+            loop = self._loop
+        if loop is None:
+            return asyncio.run(coro)
+        return asyncio.run_coroutine_threadsafe(coro, loop).result(timeout)
+
+    async def _enqueue(self, inputs):
+        result = self._loop.create_future()
+        await self._queue.put((inputs, result))
+        return await result
+
+    async def _collect_batches(self):
+        while True:
+            batch = [await self._queue.get()]
+            deadline = self._loop.time() + self._max_wait
+            while len(batch) < self._max_size:
+                timeout = deadline - self._loop.time()
+                try:
+                    if timeout <= 0:
+                        # Окно истекло (или выключено): забираем только то, что уже в очереди
+                        batch.append(self._queue.get_nowait())
+                    else:
+                        batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                    break
+            self._dispatch(batch)
+
+    def _dispatch(self, batch):
+        try:
+            calls = list(self._run_batch([inputs for inputs, _ in batch]))
+            if len(calls) != len(batch):
+                for call in calls:
+                    if asyncio.iscoroutine(call):
+                        call.close()
+                raise RuntimeError(f"run_batch returned {len(calls)} results for {len(batch)} inputs")
+        except Exception as e:
+            for _, result in batch:
+                if not result.done():
+                    result.set_exception(e)
+            return
+
+        for (_, result), call in zip(batch, calls):
+            task = asyncio.ensure_future(call)
+            task.add_done_callback(functools.partial(self._resolve, result))
+
+    @staticmethod
+    def _resolve(result, task):
+        if result.done():
+            return
+        if task.cancelled():
+            result.cancel()
+        elif task.exception() is not None:
+            result.set_exception(task.exception())
+        else:
+            result.set_result(task.result())
+
+
+async def ask_llm(inputs):
+    """Отправляет один промпт в LLM и возвращает текст ответа."""
+    response = await llm.ainvoke(build_llm_messages(inputs['chat_history'], inputs['new_message']))
+    return response.content
+
+
+def run_llm_batch(batch_inputs):
+    """Запускает пачку промптов параллельно: у xAI/OpenAI нет пакетного API."""
+    return [ask_llm(inputs) for inputs in batch_inputs]
+
+
+async def kickoff_crew(inputs):
+    """Запускает Crew для одного набора входных данных и возвращает текст ответа."""
+    # Crew интерполирует входные данные прямо в задачи, поэтому общий экземпляр
+    # нельзя запускать конкурентно: каждый запуск идет на своей копии
+    crew_result = await crew.copy().kickoff_async(inputs=inputs)
+    return crew_result.raw
+
+
+def run_crew_batch(batch_inputs):
+    """Запускает пачку входных данных параллельно, каждую на своей копии Crew."""
+    return [kickoff_crew(inputs) for inputs in batch_inputs]
+
+
+def create_llm_batcher():
+    """Создает батчер, который отправляет пачки в LLM напрямую или через Crew."""
+    return MicroBatcher(run_crew_batch if USE_CREWAI else run_llm_batch, BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS)
+
+
+llm_batcher = create_llm_batcher()
+
+
+@atexit.register
+def close_http_clients():
+    """Закрывает общие HTTP-клиенты при остановке процесса."""
+    SHARED_HTTP_CLIENT.close()
+    llm_batcher.run_in_loop(SHARED_ASYNC_HTTP_CLIENT.aclose(), timeout=5)
+
+
+# --- Схема входных данных ---
+class ChatMessage(BaseModel):
+    """Сообщение из чата. Лишние поля от бота игнорируются."""
+    model_config = ConfigDict(coerce_numbers_to_str=True)
+
+    sender: str
+    # У медиа, стикеров и т.п. текста нет
+    text: str | None = None
+    # Отправитель сообщения, на которое отвечают (если это ответ)
+    reply_to_sender: str | None = None
+
+
+class MessageRequest(BaseModel):
+    """Тело запроса /process_message."""
+    chat_id: int | str
+    new_message: ChatMessage
+    history: list[ChatMessage]
+
+
+# --- Предфильтр сообщений ---
+# В RE2 \b понимает только ASCII, поэтому для кириллицы границу слова задаем классами
+if trigger_regex is re:
+    _WORD_START = _WORD_END = r'\b'
+else:
+    _WORD_START, _WORD_END = r'(?:^|[^\pL\pN_])', r'(?:[^\pL\pN_]|$)'
+
+_trigger_patterns = [r'\?']
+if AGENT_NAMES:
+    _trigger_patterns.append(_WORD_START + '(?:' + '|'.join(map(re.escape, AGENT_NAMES)) + ')' + _WORD_END)
+if TELEGRAM_BOT_ID:
+    _trigger_patterns.append('@' + re.escape(TELEGRAM_BOT_ID))
+TRIGGER_RE = trigger_regex.compile('|'.join(_trigger_patterns))
+
+
+def needs_ai_response(new_message):
+    """Дешевая проверка до вызова LLM: может ли боту понадобиться ответить."""
+    # Без TELEGRAM_BOT_ID сравнения с ним бессмысленны (None == None для любого сообщения)
+    if TELEGRAM_BOT_ID and new_message.sender == TELEGRAM_BOT_ID:
+        return False
+    if not PREFILTER_ENABLED:
+        return True
+    if TELEGRAM_BOT_ID and new_message.reply_to_sender == TELEGRAM_BOT_ID:
+        return True
+    return TRIGGER_RE.search(new_message.text or "") is not None
+
+
+# --- Окно истории ---
+if HISTORY_TOKEN_BUDGET > 0:
+    import tiktoken
+
+    # Токенизатор gpt-4o; для других моделей это приближенная, но достаточная оценка
+    _history_encoding = tiktoken.get_encoding("o200k_base")
+else:
+    _history_encoding = None
+
+
+def trim_history(history):
+    """Оставляет последние MAX_HISTORY сообщений, а из них — те, что укладываются в HISTORY_TOKEN_BUDGET."""
+    if MAX_HISTORY > 0:
+        history = history[-MAX_HISTORY:]
+    if _history_encoding is None:
+        return history
+
+    # Идем от новых сообщений к старым, пока не кончится бюджет
+    budget = HISTORY_TOKEN_BUDGET
+    start = len(history)
+    while start > 0:
+        # encode_ordinary: спецтокены вроде <|endoftext|> в тексте пользователя — обычный текст
+        budget -= len(_history_encoding.encode_ordinary(history[start - 1].text or ""))
+        if budget < 0:
+            break
+        start -= 1
+    return history[start:]
+
 
 # --- Форматирование входных данных для Задачи ---
+_get_sender_and_text = attrgetter('sender', 'text')
+
+
 def format_chat_data(history, new_message):
     """Форматирует историю и новое сообщение в строки для промпта."""
-    history_str = "\n".join([f"[{msg['sender']}]: {msg['text']}" for msg in history])
-    new_message_str = f"[{new_message['sender']}]: {new_message['text']}"
+    history = trim_history(history)
+    # Сообщения без текста (медиа, стикеры) выводим с пустым текстом
+    history_str = "\n".join(f"[{sender}]: {text or ''}" for sender, text in map(_get_sender_and_text, history))
+    new_message_str = f"[{new_message.sender}]: {new_message.text or ''}"
     return history_str, new_message_str
 
 
-# --- API Эндпоинт ---
-@app.route('/process_message', methods=['POST'])
-def handle_process_message():
-    """Обрабатывает входящие сообщения от Telegram бота."""
+# --- Кэш ответов ---
+_response_cache = TTLCache(maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL) if RESPONSE_CACHE_TTL > 0 else None
+# Запросы, ответ на которые еще считается: повтор вебхука ждет первый вызов, а не делает свой
+_pending_responses = {}
+_response_cache_lock = threading.Lock()
+# Закэшированный ответ может быть None, поэтому промах отличаем по отдельному маркеру
+_MISS = object()
+
+
+def response_cache_key(chat_id, history_str, new_message_str):
+    """Хэш промпта вместе с id чата, чтобы ответы не утекали между чатами."""
+    digest = hashlib.blake2b(digest_size=16)
+    for part in (str(chat_id), history_str, new_message_str):
+        digest.update(part.encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def start_response(key):
+    """Ищет ответ в кэше и среди запросов в работе. Возвращает (future, is_owner).
+
+    Если is_owner=True, ответ должен посчитать вызывающий и затем обязательно вызвать
+    finish_response. Иначе future уже готов (ответ из кэша) или завершится, когда
+    закончит такой же запрос, пришедший раньше.
+    """
+    with _response_cache_lock:
+        cached = _response_cache.get(key, _MISS) if _response_cache is not None else _MISS
+        if cached is not _MISS:
+            future = Future()
+            future.set_result(cached)
+            return future, False
+        future = _pending_responses.get(key)
+        if future is not None:
+            return future, False
+        future = _pending_responses[key] = Future()
+        return future, True
+
+
+def finish_response(key, response_text=None, error=None):
+    """Отдает ответ (в том числе None) ожидающим дублям и кладет его в кэш. Повторный вызов ничего не делает."""
+    with _response_cache_lock:
+        future = _pending_responses.pop(key, None)
+        if future is None:
+            return
+        if error is None and _response_cache is not None:
+            _response_cache[key] = response_text
+    if error is None:
+        future.set_result(response_text)
+    else:
+        future.set_exception(error)
+
+
+def build_llm_messages(history_str, new_message_str):
+    """Собирает сообщения для прямого вызова LLM в обход Crew."""
+    return [
+        SystemMessage(content=PERSONA_SYSTEM_PROMPT),
+        HumanMessage(content=USER_PROMPT_TEMPLATE.format(chat_history=history_str, new_message=new_message_str)),
+    ]
+
+
+def read_message_request():
+    """Читает и валидирует тело запроса. Возвращает (payload, None) или (None, ответ с ошибкой)."""
     if not request.is_json:
         logging.warning("Request is not JSON")
-        return jsonify({"error": "Request must be JSON"}), 400
+        return None, (jsonify({"error": "Request must be JSON"}), 400)
+
+    # Разбор JSON и валидация схемы за один проход в pydantic-core
+    try:
+        payload = MessageRequest.model_validate_json(request.get_data())
+    except ValidationError as e:
+        logging.warning(f"Invalid request payload: {e}")
+        errors = e.errors(include_url=False, include_context=False, include_input=False)
+        return None, (jsonify({"error": "Invalid request payload", "details": errors}), 400)
+    logging.info(f"[Chat {payload.chat_id}] Received message, history: {len(payload.history)} messages")
+
+    return payload, None
+
+
+def to_ndjson(obj):
+    """Сериализует объект в одну строку NDJSON."""
+    return app.json.dumps(obj) + "\n"
+
+
+def stream_llm_response(chat_id, messages, cache_key):
+    """Отдает ответ LLM по мере генерации строками NDJSON.
+
+    Каждый кусок текста приходит как {"delta": "..."}, последней строкой идет
+    {"response_text": "..."} с полным ответом (или null, если AI решил не отвечать).
+    """
+    text = ""
+    streaming = False
+    try:
+        for chunk in llm.stream(messages):
+            text += chunk.content
+            if streaming:
+                delta = chunk.content
+            else:
+                # Пока ответ может оказаться маркером NO_RESPONSE, ничего не отдаем
+                head = text.lstrip()
+                if head == NO_RESPONSE_MARKER:
+                    break
+                if NO_RESPONSE_MARKER.startswith(head):
+                    continue
+                streaming = True
+                delta = head
+            if delta:
+                yield to_ndjson({"delta": delta})
+    except Exception as e:
+        logging.error(f"[Chat {chat_id}] Error during LLM streaming: {e}", exc_info=True)
+        finish_response(cache_key, error=e)
+        yield to_ndjson({"error": "Internal server error processing message with AI"})
+        return
+
+    response_text = text.strip()
+    if not response_text or response_text == NO_RESPONSE_MARKER:
+        response_text = None
+        logging.info(f"[Chat {chat_id}] No response generated by AI.")
+    else:
+        logging.info(f"[Chat {chat_id}] Streamed response: '{response_text}'")
+    finish_response(cache_key, response_text)
+    yield to_ndjson({"response_text": response_text})
 
-    data = request.get_json()
-    logging.info(f"Received data: {data}")
 
-    # Валидация входных данных (базовая)
-    if not data or 'chat_id' not in data or 'new_message' not in data or 'history' not in data:
-        logging.warning("Missing required fields in JSON data")
-        return jsonify({"error": "Missing required fields: chat_id, new_message, history"}), 400
+# --- API Эндпоинты ---
+@app.route('/process_message', methods=['POST'])
+def handle_process_message():
+    """Обрабатывает входящие сообщения от Telegram бота."""
+    payload, error_response = read_message_request()
+    if error_response:
+        return error_response
 
-    chat_id = data['chat_id']
-    new_message = data['new_message']  # Ожидаем {'text': '...', 'sender': '...', ...}
-    history = data['history']  # Ожидаем список [ {'text': '...', 'sender': '...'}, ... ]
+    chat_id = payload.chat_id
+    new_message = payload.new_message
+    history = payload.history
 
-    # Форматируем данные для CrewAI
+    if not needs_ai_response(new_message):
+        logging.info(f"[Chat {chat_id}] Message skipped by prefilter, LLM not called.")
+        return jsonify({"response_text": None})
+
+    # Форматируем данные для промпта
     try:
         history_str, new_message_str = format_chat_data(history, new_message)
-        logging.info(f"Formatted History for Crew: \n{history_str}")
-        logging.info(f"Formatted New Message for Crew: \n{new_message_str}")
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(f"Formatted History: \n{history_str}")
+            logging.debug(f"Formatted New Message: \n{new_message_str}")
     except Exception as e:
         logging.error(f"Error formatting chat data: {e}", exc_info=True)
         return jsonify({"error": "Internal server error formatting data"}), 500
 
-    # Запуск CrewAI
+    cache_key = response_cache_key(chat_id, history_str, new_message_str)
+    pending_response, is_owner = start_response(cache_key)
+    if not is_owner:
+        logging.info(f"[Chat {chat_id}] Reusing cached or in-flight response.")
+        try:
+            return jsonify({"response_text": pending_response.result(timeout=LLM_DEADLINE)})
+        except Exception as e:
+            logging.error(f"[Chat {chat_id}] Duplicate request failed with the original: {e}")
+            return jsonify({"error": "Internal server error processing message with AI"}), 500
+
+    # Запрос к LLM (напрямую или через CrewAI)
     try:
-        logging.info(f"[Chat {chat_id}] Starting Crew kickoff...")
-        # Используем словарь для входных данных, как ожидает Task
+        logging.info(f"[Chat {chat_id}] Starting LLM call...")
         inputs = {
             'chat_history': history_str,
             'new_message': new_message_str
         }
-        crew_result = crew.kickoff(inputs=inputs)
-        logging.info(f"[Chat {chat_id}] Crew kickoff finished. Result: '{crew_result}'")
+        # Поток воркера ждет ответа LLM; сам вызов идет в loop'е батчера,
+        # а одновременные запросы уходят к провайдеру вместе
+        raw_result = llm_batcher.submit(inputs, timeout=LLM_DEADLINE)
+        logging.info(f"[Chat {chat_id}] LLM call finished.")
 
         # Обработка результата
         response_text = None
-        if crew_result and crew_result.raw and crew_result.raw.strip() != NO_RESPONSE_MARKER:
-            response_text = crew_result.raw.strip()
+        if raw_result and raw_result.strip() != NO_RESPONSE_MARKER:
+            response_text = raw_result.strip()
             logging.info(f"[Chat {chat_id}] Sending response: '{response_text}'")
         else:
             logging.info(f"[Chat {chat_id}] No response generated by AI.")
 
+        finish_response(cache_key, response_text)
         return jsonify({"response_text": response_text})
 
     except Exception as e:
-        logging.error(f"[Chat {chat_id}] Error during Crew kickoff or processing: {e}", exc_info=True)
+        logging.error(f"[Chat {chat_id}] Error during LLM call or processing: {e}", exc_info=True)
+        finish_response(cache_key, error=e)
         return jsonify({"error": "Internal server error processing message with AI"}), 500
+    finally:
+        # Дубли не должны ждать ключ, который никто не завершит; после finish_response ничего не делает
+        finish_response(cache_key, error=RuntimeError("Request ended before the response was ready"))
+
+
+@app.route('/process_message/stream', methods=['POST'])
+def handle_process_message_stream():
+    """То же, что /process_message, но отдает ответ потоком."""
+    payload, error_response = read_message_request()
+    if error_response:
+        return error_response
+
+    chat_id = payload.chat_id
+    if not needs_ai_response(payload.new_message):
+        logging.info(f"[Chat {chat_id}] Message skipped by prefilter, LLM not called.")
+        return Response(to_ndjson({"response_text": None}), mimetype='application/x-ndjson')
+
+    try:
+        history_str, new_message_str = format_chat_data(payload.history, payload.new_message)
+    except Exception as e:
+        logging.error(f"Error formatting chat data: {e}", exc_info=True)
+        return jsonify({"error": "Internal server error formatting data"}), 500
+
+    cache_key = response_cache_key(chat_id, history_str, new_message_str)
+    pending_response, is_owner = start_response(cache_key)
+    if not is_owner:
+        logging.info(f"[Chat {chat_id}] Reusing cached or in-flight response.")
+        try:
+            return Response(
+                to_ndjson({"response_text": pending_response.result(timeout=LLM_DEADLINE)}),
+                mimetype='application/x-ndjson',
+            )
+        except Exception as e:
+            logging.error(f"[Chat {chat_id}] Duplicate request failed with the original: {e}")
+            return jsonify({"error": "Internal server error processing message with AI"}), 500
+
+    try:
+        logging.info(f"[Chat {chat_id}] Starting LLM stream...")
+        messages = build_llm_messages(history_str, new_message_str)
+        response = Response(stream_llm_response(chat_id, messages, cache_key), mimetype='application/x-ndjson')
+        # Если клиент отключился, не дочитав поток, дубли не должны ждать вечно
+        response.call_on_close(lambda: finish_response(cache_key, error=RuntimeError("Stream closed before completion")))
+    except BaseException as e:
+        finish_response(cache_key, error=e)
+        raise
+    return response
+
 
+# --- Инициализация воркера ---
+def init_worker():
+    """Пересоздает изменяемое состояние процесса после fork (хук post_fork в gunicorn.conf.py).
 
-# --- Главная точка входа (для запуска Flask) ---
-if __name__ == '__main__':
-    # Запускаем Flask сервер
-    # host='0.0.0.0' делает его доступным извне контейнера/сети
-    # debug=True НЕ используйте в продакшене!
-    app.run(host='0.0.0.0', port=5000, debug=False)
-    # Для продакшена лучше использовать Gunicorn или uWSGI
-    # gunicorn -w 4 -b 0.0.0.0:5000 app:app
+    Промпты, конфигурация и Crew строятся один раз в мастере и остаются общими
+    страницами памяти. Логирование, HTTP-клиенты, батчер с его потоком и блокировки
+    у каждого воркера должны быть свои.
+    """
+    global SHARED_HTTP_CLIENT, SHARED_ASYNC_HTTP_CLIENT, llm, llm_batcher, _response_cache_lock, _pending_responses
+    # Поток разбора очереди логов запускается только в воркере, после fork
+    configure_logging()
+    SHARED_HTTP_CLIENT, SHARED_ASYNC_HTTP_CLIENT = create_http_clients()
+    llm = create_llm(SHARED_HTTP_CLIENT, SHARED_ASYNC_HTTP_CLIENT)
+    llm_batcher = create_llm_batcher()
+    _response_cache_lock = threading.Lock()
+    _pending_responses = {}
@@ -0,0 +1,15 @@
+# Окружение для тестов: задается до импорта app, который читает его при загрузке.
+# LLM в тестах не вызывается, ключ нужен только для проверки при старте
+import os
+
+os.environ.update({
+    "LLM_PROVIDER": "xai",
+    "XAI_API_KEY": "test-key",
+    "TELEGRAM_BOT_ID": "bro_test_bot",
+    "PERSONA": "bro",
+    "PREFILTER_ENABLED": "1",
+    "USE_CREWAI": "0",
+    "MAX_HISTORY": "20",
+    "HISTORY_TOKEN_BUDGET": "0",
+    "BATCH_MAX_WAIT_MS": "0",
+})
@@ -0,0 +1,28 @@
+# Конфигурация Gunicorn
+# Запуск: gunicorn -c gunicorn.conf.py app:app
+import multiprocessing
+import os
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.getenv("GUNICORN_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+
+# Flask — WSGI-приложение, поэтому ASGI-воркеры (UvicornWorker) ему не подходят.
+# Каждый поток gthread-воркера держит один запрос на время ответа LLM, поэтому
+# число одновременных запросов на воркер равно threads
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+
+keepalive = 30
+# Ответ LLM может генерироваться десятки секунд
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+
+# Приложение (промпты, конфигурация, Crew при USE_CREWAI) загружается один раз в мастере
+# и достается воркерам через fork (copy-on-write)
+preload_app = True
+
+
+def post_fork(server, worker):
+    # Поток логирования, HTTP-клиенты, фоновый loop батчера и блокировки у каждого воркера свои
+    import app
+
+    app.init_worker()
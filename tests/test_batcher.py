@@ -0,0 +1,164 @@
+import asyncio
+import concurrent.futures
+import threading
+import time
+
+import pytest
+
+from app import MicroBatcher
+
+
+def submit_concurrently(batcher, items):
+    """Отправляет items из отдельных потоков, как это делают потоки gunicorn."""
+    results = {}
+
+    def worker(item):
+        try:
+            results[item] = batcher.submit(item, timeout=5)
+        except Exception as e:
+            results[item] = e
+
+    threads = [threading.Thread(target=worker, args=(item,)) for item in items]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+async def echo(item):
+    return item
+
+
+def test_results_are_returned_to_their_submitters():
+    batch_sizes = []
+
+    async def double(item):
+        await asyncio.sleep(0.05)
+        return item * 2
+
+    def run_batch(batch):
+        batch_sizes.append(len(batch))
+        return [double(item) for item in batch]
+
+    batcher = MicroBatcher(run_batch, max_size=4, max_wait_ms=100)
+    results = submit_concurrently(batcher, range(10))
+
+    assert results == {item: item * 2 for item in range(10)}
+    assert sum(batch_sizes) == 10
+    assert max(batch_sizes) <= 4
+
+
+def test_item_error_fails_only_its_submitter():
+    async def check(item):
+        if item == 3:
+            raise ValueError(item)
+        return item
+
+    def run_batch(batch):
+        return [check(item) for item in batch]
+
+    batcher = MicroBatcher(run_batch, max_size=8, max_wait_ms=50)
+    results = submit_concurrently(batcher, range(5))
+
+    assert isinstance(results[3], ValueError)
+    assert {item: results[item] for item in (0, 1, 2, 4)} == {0: 0, 1: 1, 2: 2, 4: 4}
+
+
+def test_batch_error_fails_every_submitter():
+    def run_batch(batch):
+        raise RuntimeError("provider down")
+
+    batcher = MicroBatcher(run_batch, max_size=8, max_wait_ms=50)
+    results = submit_concurrently(batcher, range(3))
+
+    assert all(isinstance(result, RuntimeError) for result in results.values())
+
+
+def test_result_count_mismatch_fails_every_submitter():
+    def run_batch(batch):
+        return [echo(item) for item in batch[:-1]]
+
+    batcher = MicroBatcher(run_batch, max_size=8, max_wait_ms=50)
+    results = submit_concurrently(batcher, range(3))
+
+    assert all(isinstance(result, RuntimeError) for result in results.values())
+
+
+def test_submit_times_out():
+    async def hang(item):
+        await asyncio.sleep(5)
+
+    def run_batch(batch):
+        return [hang(item) for item in batch]
+
+    batcher = MicroBatcher(run_batch, max_size=8, max_wait_ms=0)
+    with pytest.raises(concurrent.futures.TimeoutError):
+        batcher.submit("item", timeout=0.05)
+
+
+def test_single_request_is_not_delayed_without_wait_window():
+    def run_batch(batch):
+        return [echo(item) for item in batch]
+
+    batcher = MicroBatcher(run_batch, max_size=8, max_wait_ms=0)
+    batcher.submit("warm-up", timeout=5)
+
+    started = time.monotonic()
+    assert batcher.submit("item", timeout=5) == "item"
+    assert time.monotonic() - started < 0.05
+
+
+def test_fast_item_is_not_delayed_by_slow_item_in_batch():
+    delays = {"fast-1": 0.1, "slow": 2.0, "fast-2": 0.1, "fast-3": 0.1}
+    batch_sizes = []
+    finished = {}
+    started = time.monotonic()
+
+    async def sleep_for(item):
+        await asyncio.sleep(delays[item])
+        return item
+
+    def run_batch(batch):
+        batch_sizes.append(len(batch))
+        return [sleep_for(item) for item in batch]
+
+    batcher = MicroBatcher(run_batch, max_size=8, max_wait_ms=200)
+    original_submit = batcher.submit
+
+    def timed_submit(item, timeout=None):
+        result = original_submit(item, timeout)
+        finished[item] = time.monotonic() - started
+        return result
+
+    batcher.submit = timed_submit
+    results = submit_concurrently(batcher, delays)
+
+    assert batch_sizes == [4]
+    assert results == {item: item for item in delays}
+    assert all(finished[item] < 1.0 for item in ("fast-1", "fast-2", "fast-3"))
+    assert finished["slow"] >= 2.0
+
+
+def test_run_in_loop_without_started_loop():
+    def run_batch(batch):
+        return [echo(item) for item in batch]
+
+    async def answer():
+        return 42
+
+    batcher = MicroBatcher(run_batch, max_size=8, max_wait_ms=0)
+    assert batcher.run_in_loop(answer()) == 42
+
+
+@pytest.mark.parametrize("max_wait_ms", [0, 50])
+def test_submit_after_loop_started(max_wait_ms):
+    async def upper(item):
+        return item.upper()
+
+    def run_batch(batch):
+        return [upper(item) for item in batch]
+
+    batcher = MicroBatcher(run_batch, max_size=8, max_wait_ms=max_wait_ms)
+    assert batcher.submit("a", timeout=5) == "A"
+    assert batcher.submit("b", timeout=5) == "B"
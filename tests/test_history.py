@@ -0,0 +1,80 @@
+import pytest
+
+import app
+from app import ChatMessage, format_chat_data, trim_history
+
+
+class WordEncoding:
+    """Считает слова как токены и, как tiktoken.encode по умолчанию, падает на спецтокенах."""
+
+    def encode(self, text):
+        if "<|endoftext|>" in text:
+            raise ValueError("disallowed special token")
+        return text.split()
+
+    def encode_ordinary(self, text):
+        return text.split()
+
+
+def make_history(*word_counts):
+    return [ChatMessage(sender=f"user{i}", text=" ".join(["слово"] * count)) for i, count in enumerate(word_counts)]
+
+
+def word_counts(history):
+    return [len(message.text.split()) for message in history]
+
+
+@pytest.fixture
+def token_budget(monkeypatch):
+    def set_budget(budget, max_history=0):
+        monkeypatch.setattr(app, "MAX_HISTORY", max_history)
+        monkeypatch.setattr(app, "HISTORY_TOKEN_BUDGET", budget)
+        monkeypatch.setattr(app, "_history_encoding", WordEncoding())
+    return set_budget
+
+
+def test_keeps_last_max_history_messages(monkeypatch):
+    monkeypatch.setattr(app, "MAX_HISTORY", 2)
+
+    assert word_counts(trim_history(make_history(5, 3, 4, 2))) == [4, 2]
+
+
+def test_zero_max_history_keeps_everything(monkeypatch):
+    monkeypatch.setattr(app, "MAX_HISTORY", 0)
+
+    assert word_counts(trim_history(make_history(5, 3, 4, 2))) == [5, 3, 4, 2]
+
+
+@pytest.mark.parametrize("budget, expected", [
+    (14, [5, 3, 4, 2]),
+    (9, [3, 4, 2]),
+    (8, [4, 2]),
+    (2, [2]),
+    (1, []),
+])
+def test_token_budget_drops_oldest_messages(token_budget, budget, expected):
+    token_budget(budget)
+
+    assert word_counts(trim_history(make_history(5, 3, 4, 2))) == expected
+
+
+def test_token_budget_applies_after_max_history(token_budget):
+    token_budget(100, max_history=3)
+
+    assert word_counts(trim_history(make_history(5, 3, 4, 2))) == [3, 4, 2]
+
+
+def test_special_token_text_does_not_raise(token_budget):
+    token_budget(10)
+    history = [ChatMessage(sender="user", text="смотри <|endoftext|>"), ChatMessage(sender="user", text=None)]
+
+    assert trim_history(history) == history
+
+
+def test_format_chat_data_renders_missing_text_as_empty():
+    history = [ChatMessage(sender="user", text="привет"), ChatMessage(sender="user2", text=None)]
+
+    history_str, new_message_str = format_chat_data(history, ChatMessage(sender="user3", text=None))
+
+    assert history_str == "[user]: привет\n[user2]: "
+    assert new_message_str == "[user3]: "
@@ -0,0 +1,60 @@
+import pytest
+
+import app
+from app import ChatMessage, needs_ai_response
+
+BOT_ID = "bro_test_bot"
+
+
+@pytest.mark.parametrize("text", [
+    "Бро, как дела",
+    "ну что скажешь, Бро",
+    "(Бро)",
+    "Bro!",
+    "кто-нибудь знает?",
+    f"эй @{BOT_ID}",
+])
+def test_trigger_matches_direct_address(text):
+    assert app.TRIGGER_RE.search(text)
+
+
+@pytest.mark.parametrize("text", [
+    "привет всем",
+    "Бровь",
+    "ЗаБро",
+    "Brother",
+    "бро с маленькой",
+    "@other_bot",
+])
+def test_trigger_ignores_other_text(text):
+    assert not app.TRIGGER_RE.search(text)
+
+
+def test_own_message_never_needs_response():
+    assert not needs_ai_response(ChatMessage(sender=BOT_ID, text="Бро?"))
+
+
+def test_reply_to_bot_needs_response_without_trigger():
+    assert needs_ai_response(ChatMessage(sender="user", text="ага", reply_to_sender=BOT_ID))
+
+
+def test_untriggered_message_is_skipped():
+    assert not needs_ai_response(ChatMessage(sender="user", text="ага"))
+
+
+def test_message_without_text_is_skipped():
+    assert not needs_ai_response(ChatMessage(sender="user", text=None))
+
+
+def test_disabled_prefilter_lets_everything_but_own_messages_through(monkeypatch):
+    monkeypatch.setattr(app, "PREFILTER_ENABLED", False)
+
+    assert needs_ai_response(ChatMessage(sender="user", text="ага"))
+    assert not needs_ai_response(ChatMessage(sender=BOT_ID, text="ага"))
+
+
+def test_unset_bot_id_does_not_match_missing_reply(monkeypatch):
+    monkeypatch.setattr(app, "TELEGRAM_BOT_ID", None)
+
+    assert not needs_ai_response(ChatMessage(sender="user", text="ага"))
+    assert needs_ai_response(ChatMessage(sender="user", text="Бро?"))
@@ -0,0 +1,83 @@
+import orjson
+import pytest
+
+import app
+
+
+class FakeChunk:
+    def __init__(self, content):
+        self.content = content
+
+
+class FakeStreamingLLM:
+    """Отдает заранее заданные куски и считает, сколько из них было прочитано."""
+
+    def __init__(self, parts, error=None):
+        self.parts = parts
+        self.error = error
+        self.consumed = 0
+
+    def stream(self, messages):
+        for part in self.parts:
+            self.consumed += 1
+            yield FakeChunk(part)
+        if self.error:
+            raise self.error
+
+
+def run_stream(monkeypatch, parts, error=None):
+    fake_llm = FakeStreamingLLM(parts, error)
+    monkeypatch.setattr(app, "llm", fake_llm)
+    lines = [orjson.loads(line) for line in app.stream_llm_response("chat", [], "stream-test-key")]
+    return lines, fake_llm
+
+
+def test_text_is_streamed_as_deltas_with_final_response(monkeypatch):
+    lines, _ = run_stream(monkeypatch, ["Нормально", ", бро", ")"])
+
+    assert lines == [
+        {"delta": "Нормально"},
+        {"delta": ", бро"},
+        {"delta": ")"},
+        {"response_text": "Нормально, бро)"},
+    ]
+
+
+def test_no_response_marker_aborts_stream_without_deltas(monkeypatch):
+    lines, fake_llm = run_stream(monkeypatch, [" NO", "_RESP", "ONSE", " лишнее"])
+
+    assert lines == [{"response_text": None}]
+    assert fake_llm.consumed == 3
+
+
+def test_marker_prefix_is_flushed_once_text_diverges(monkeypatch):
+    lines, _ = run_stream(monkeypatch, ["NO_RES", "T", " day"])
+
+    assert lines == [{"delta": "NO_REST"}, {"delta": " day"}, {"response_text": "NO_REST day"}]
+
+
+@pytest.mark.parametrize("parts", [[], ["  ", "\n"]])
+def test_empty_output_means_no_response(monkeypatch, parts):
+    lines, _ = run_stream(monkeypatch, parts)
+
+    assert lines == [{"response_text": None}]
+
+
+def test_llm_error_ends_stream_with_error_line(monkeypatch):
+    lines, _ = run_stream(monkeypatch, ["Да"], error=RuntimeError("boom"))
+
+    assert lines[0] == {"delta": "Да"}
+    assert list(lines[-1]) == ["error"]
+
+
+def test_stream_endpoint_skips_llm_for_prefiltered_message(monkeypatch):
+    monkeypatch.setattr(app, "llm", FakeStreamingLLM(["не должно вызываться"]))
+    response = app.app.test_client().post('/process_message/stream', json={
+        "chat_id": 1,
+        "new_message": {"sender": "user", "text": "просто болтаем"},
+        "history": [],
+    })
+
+    assert response.mimetype == 'application/x-ndjson'
+    assert response.get_data(as_text=True) == '{"response_text":null}\n'
+    assert app.llm.consumed == 0